@@ -1,13 +1,18 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
 import uuid
 import threading
-from datetime import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, render_template, request, send_file, jsonify, url_for
 
-from processor import process_excel
+from tasks import init_db, add_log, format_log, set_status, get_status, get_db, run_task
 
 app = Flask(__name__)
+# 部署在 nginx/apache 后面时设置 USE_X_SENDFILE=1，由前端服务器直接发文件
+app.use_x_sendfile = os.getenv("USE_X_SENDFILE") == "1"
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
@@ -16,25 +21,64 @@ OUTPUT_DIR = os.path.join(BASE_DIR, "outputs")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# 日志与状态（演示够用）
-TASK_LOGS = {}      # task_id -> list[str]
-TASK_STATUS = {}    # task_id -> {"state": "running|done|error", "error": str|None}
+UPLOAD_CHUNK_SIZE = 1 << 20  # 上传文件落盘时每次拷贝 1MB
+TASK_WORKERS = max(1, int(os.getenv("TASK_WORKERS", "4")))  # 同时处理的任务数（每个任务一个子进程）
 
+LOG_PAGE_SIZE = 1000   # 每次轮询最多返回的日志条数
 
-def add_log(task_id: str, msg: str):
-    t = datetime.now().strftime("%H:%M:%S")
-    TASK_LOGS.setdefault(task_id, []).append(f"[{t}] {msg}")
+init_db()
 
+# 任务放到子进程里跑：读写 Excel 的 CPU 部分不和 Flask 抢 GIL；日志/状态直接写 sqlite，不用回传
+# 用 spawn 而不是 fork：父进程里有 Flask 线程和 sqlite 连接，fork 后不安全；
+# run_task 放在 tasks.py 里，子进程只导入它，不会再建一遍 Flask 应用、进程池和目录
+def _new_executor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=TASK_WORKERS, mp_context=multiprocessing.get_context("spawn"))
 
-def run_task(task_id: str, param_path: str, report_path: str, out_path: str):
+
+EXECUTOR = _new_executor()
+_executor_lock = threading.Lock()
+
+
+def submit_task(*args):
+    """提交后台任务；子进程被杀（如 OOM）后进程池会永久失效，这时重建一个再提交一次"""
+    global EXECUTOR
+    executor = EXECUTOR
     try:
-        add_log(task_id, "后台任务开始执行…")
-        process_excel(param_path, report_path, out_path, log_fn=lambda m: add_log(task_id, m))
-        add_log(task_id, "后台任务完成 ✅")
-        TASK_STATUS[task_id] = {"state": "done", "error": None}
-    except Exception as e:
+        return executor.submit(run_task, *args)
+    except BrokenProcessPool:
+        with _executor_lock:
+            # 并发请求可能已经重建过了，只重建一次
+            if EXECUTOR is executor:
+                EXECUTOR = _new_executor()
+                executor.shutdown(wait=False)
+            executor = EXECUTOR
+        return executor.submit(run_task, *args)
+
+
+OUTPUT_FORMATS = ("xlsx", "csv")
+
+
+def output_path(task_id: str, fmt: str = "xlsx") -> str:
+    return os.path.join(OUTPUT_DIR, f"{task_id}_最终结果.{fmt}")
+
+
+def get_format() -> str:
+    fmt = (request.args.get("format") or request.form.get("format") or "xlsx").lower()
+    return fmt if fmt in OUTPUT_FORMATS else "xlsx"
+
+
+def save_upload(file_storage, path: str):
+    # 直接按大块从上传流拷到磁盘，比 FileStorage.save 默认的 16KB 小块少很多次读写
+    with open(path, "wb") as f:
+        shutil.copyfileobj(file_storage.stream, f, length=UPLOAD_CHUNK_SIZE)
+
+
+def on_task_finished(task_id: str, future):
+    # run_task 自己会记录成功/失败；这里只兜底子进程崩溃等没能写状态的情况
+    e = future.exception()
+    if e is not None:
         add_log(task_id, f"后台任务失败 ❌：{type(e).__name__}: {e}")
-        TASK_STATUS[task_id] = {"state": "error", "error": f"{type(e).__name__}: {e}"}
+        set_status(task_id, "error", f"{type(e).__name__}: {e}")
 
 
 @app.route("/", methods=["GET"])
@@ -44,7 +88,7 @@ def index():
 
 @app.route("/api/start", methods=["POST"])
 def start():
-    # 只负责：收文件 + 保存 + 启动后台线程 + 立刻返回 task_id
+    # 只负责：收文件 + 保存 + 提交后台任务 + 立刻返回 task_id
     if "param_file" not in request.files or "report_file" not in request.files:
         return jsonify({"error": "请上传 参数表 和 报表 两个文件"}), 400
 
@@ -55,8 +99,7 @@ def start():
         return jsonify({"error": "文件名为空，请重新选择文件"}), 400
 
     task_id = str(uuid.uuid4())
-    TASK_LOGS[task_id] = []
-    TASK_STATUS[task_id] = {"state": "running", "error": None}
+    set_status(task_id, "running")
 
     add_log(task_id, f"收到参数表：{param_file.filename}")
     add_log(task_id, f"收到报表：{report_file.filename}")
@@ -64,19 +107,26 @@ def start():
 
     param_path = os.path.join(UPLOAD_DIR, f"{task_id}_param.xlsx")
     report_path = os.path.join(UPLOAD_DIR, f"{task_id}_report.xlsx")
-    param_file.save(param_path)
-    report_file.save(report_path)
+    save_upload(param_file, param_path)
+    save_upload(report_file, report_path)
 
     add_log(task_id, "文件保存完成，启动后台处理…")
 
-    out_path = os.path.join(OUTPUT_DIR, f"{task_id}_最终结果.xlsx")
+    # ?format=csv 时直接写 CSV，省掉 xlsx 的打包开销
+    fmt = get_format()
+    out_path = output_path(task_id, fmt)
 
-    t = threading.Thread(target=run_task, args=(task_id, param_path, report_path, out_path), daemon=True)
-    t.start()
+    try:
+        future = submit_task(task_id, param_path, report_path, out_path)
+    except Exception as e:
+        add_log(task_id, f"后台任务提交失败 ❌：{type(e).__name__}: {e}")
+        set_status(task_id, "error", f"{type(e).__name__}: {e}")
+        return jsonify({"error": f"后台任务提交失败：{e}", "task_id": task_id}), 500
+    future.add_done_callback(lambda fut: on_task_finished(task_id, fut))
 
     return jsonify({
         "task_id": task_id,
-        "download_url": url_for("download", task_id=task_id),
+        "download_url": url_for("download", task_id=task_id, format=fmt),
         "status_url": url_for("status", task_id=task_id),
         "log_url": url_for("get_log", task_id=task_id),
     })
@@ -84,30 +134,38 @@ def start():
 
 @app.route("/api/log/<task_id>", methods=["GET"])
 def get_log(task_id):
-    return jsonify({"logs": TASK_LOGS.get(task_id, [])})
+    # ?since=N 只返回 id > N 的日志；next 是下次轮询要带的 since
+    since = request.args.get("since", default=0, type=int)
+    rows = get_db().execute(
+        "SELECT id, ts, msg FROM logs WHERE task_id = ? AND id > ? ORDER BY id LIMIT ?",
+        (task_id, since, LOG_PAGE_SIZE),
+    ).fetchall()
+    next_since = rows[-1][0] if rows else since
+    return jsonify({"logs": [format_log(ts, msg) for _, ts, msg in rows], "next": next_since})
 
 
 @app.route("/api/status/<task_id>", methods=["GET"])
 def status(task_id):
-    s = TASK_STATUS.get(task_id)
+    s = get_status(task_id)
     if not s:
         return jsonify({"state": "unknown"}), 404
 
     # 双保险：文件存在也视为 done
-    out_path = os.path.join(OUTPUT_DIR, f"{task_id}_最终结果.xlsx")
-    if os.path.exists(out_path):
-        TASK_STATUS[task_id] = {"state": "done", "error": None}
-        s = TASK_STATUS[task_id]
+    if s["state"] != "done" and any(os.path.exists(output_path(task_id, fmt)) for fmt in OUTPUT_FORMATS):
+        set_status(task_id, "done")
+        s = {"state": "done", "error": None}
 
     return jsonify(s)
 
 
 @app.route("/api/download/<task_id>", methods=["GET"])
 def download(task_id):
-    out_path = os.path.join(OUTPUT_DIR, f"{task_id}_最终结果.xlsx")
+    fmt = get_format()
+    out_path = output_path(task_id, fmt)
     if not os.path.exists(out_path):
         return "任务不存在或尚未生成结果", 404
-    return send_file(out_path, as_attachment=True, download_name="最终结果.xlsx")
+    # conditional=True 支持 Range/304；未开 X-Sendfile 时交给 wsgi.file_wrapper（gunicorn 会走 sendfile）
+    return send_file(out_path, as_attachment=True, download_name=f"最终结果.{fmt}", conditional=True)
 
 
 if __name__ == "__main__":
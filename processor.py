@@ -2,35 +2,102 @@
 import os
 import re
 import json
+import math
+import numbers
 import ast
-from typing import Any, Optional, List, Callable
+import csv
+import datetime
+import functools
+import hashlib
+import importlib.util
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Optional, List, Callable, Dict
 
 import pandas as pd
-from openpyxl import Workbook
-from openai import OpenAI
+import xlsxwriter
+from openpyxl import load_workbook
+from openpyxl.utils import column_index_from_string
+from openai import APIConnectionError, APITimeoutError, InternalServerError, OpenAI, RateLimitError
+
+try:
+    import orjson  # 可选：解析大段模型输出更快
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
 
 # ======== 可调参数（不改代码也能控制）========
 DEFAULT_TIMEOUT_SEC = int(os.getenv("AI_TIMEOUT_SEC", "20"))     # 单次AI请求超时秒数
-DEFAULT_RETRIES = int(os.getenv("AI_RETRIES", "2"))              # 单个sheet重试次数
+DEFAULT_RETRIES = int(os.getenv("AI_RETRIES", "3"))              # 单个sheet最多请求几次（含第一次）
+AI_BACKOFF_SEC = float(os.getenv("AI_BACKOFF_SEC", "1"))         # 重试前等待的基数秒数，每次翻倍（并发时避免一起撞限流）
+AI_BACKOFF_MAX_SEC = float(os.getenv("AI_BACKOFF_MAX_SEC", "30"))  # 单次等待上限（含接口返回的 Retry-After）
 MAX_SHEETS = int(os.getenv("MAX_SHEETS", "0"))                   # 0表示不限制；>0表示只处理前N个sheet（调试用）
 PREVIEW_ROWS = int(os.getenv("AI_PREVIEW_ROWS", "15"))           # 传给模型的行数
 PREVIEW_COLS = int(os.getenv("AI_PREVIEW_COLS", "25"))           # 传给模型的列数
+PREVIEW_CELL_CHARS = int(os.getenv("AI_PREVIEW_CELL_CHARS", "40"))  # 单元格文本最多传多少字
+AI_CHUNK_ROWS = int(os.getenv("AI_CHUNK_ROWS", "200"))           # 大表按多少行切块分别调AI；0表示不切块，只发前 AI_PREVIEW_ROWS 行
+AI_HEADER_ROWS = int(os.getenv("AI_HEADER_ROWS", "-1"))          # 切块后每块额外重复的表头行数；-1表示自动识别（见 _detect_header_rows）
+AI_CONCURRENCY = max(1, int(os.getenv("AI_CONCURRENCY", "8")))  # 同时进行的AI请求数（多个sheet并发）
+AI_BATCH_CHARS = int(os.getenv("AI_BATCH_CHARS", "12000"))       # 多个sheet合并成一次请求的预览字符上限；0表示不合并
+AI_STREAM = os.getenv("AI_STREAM", "1") == "1"                  # 流式接收模型输出：超时按“多久没收到数据”算，长输出不会被整体超时打断
+AI_PREFILTER = os.getenv("AI_PREFILTER", "1") == "1"            # 发给模型前先去掉首列含“未划分/合计/战客”的行（规则里本来就不要这些行）
+AI_JSON_MODE = os.getenv("AI_JSON_MODE", "1") == "1"            # 合并请求要求模型按 JSON 对象输出（response_format=json_object）；接口不支持时设为0
+# AI结果缓存（sqlite + 进程内LRU），同一预览+同一模型直接复用；设为空字符串关闭缓存
+AI_CACHE_PATH = os.getenv("AI_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache.db"))
+AI_CACHE_TTL_SEC = int(os.getenv("AI_CACHE_TTL_SEC", str(24 * 3600)))  # 缓存有效期；0表示不过期
+# 读报表用的引擎：默认 calamine（Rust实现，解析比 openpyxl 快很多），没装 python-calamine 时退回 openpyxl 只读模式
+EXCEL_ENGINE = os.getenv("EXCEL_ENGINE") or (
+    "calamine" if importlib.util.find_spec("python_calamine") else "openpyxl"
+)
+
+
+class _KeepChars(dict):
+    """str.translate 用的映射表：keep(ch) 为真的字符保留，其余删除；查过的字符缓存在 dict 里"""
+
+    def __init__(self, keep: Callable[[str], bool]):
+        super().__init__()
+        self._keep = keep
+
+    def __missing__(self, code: int) -> Optional[int]:
+        value = code if self._keep(chr(code)) else None
+        self[code] = value
+        return value
+
+
+# 只留单元格里的数字/字母部分（如 "A5" -> "5"/"A"），用 translate 在 C 层逐字符过滤，不走正则
+_KEEP_DIGITS = _KeepChars(str.isdecimal)
+_KEEP_LETTERS = _KeepChars(lambda ch: ch.isascii() and ch.isalpha())
+
+# 模型输出外层的 ``` / ```json 包裹
+_RE_FENCE = re.compile(r'^```(?:json)?\s*|\s*```$')
+
+
+def _slice_between(text: str, open_token: str, close_token: str) -> Optional[str]:
+    """取第一个 open_token 到最后一个 close_token 之间的内容（模型偶尔会在前后加说明文字）；找不到返回 None"""
+    start = text.find(open_token)
+    end = text.rfind(close_token)
+    if start != -1 and end > start:
+        return text[start:end + len(close_token)]
+    return None
 
 
 def _parse_llm_list_of_lists(raw_text: str) -> List[List[Any]]:
     """尽量解析模型输出为二维列表(list[list])"""
     if raw_text is None:
         raise ValueError("模型返回为空")
-    text = raw_text.strip()
+    text = _RE_FENCE.sub('', raw_text.strip())
+    # 优先按 [[ ... ]] 截取，前面说明文字里的单个 [ 不会干扰
+    text = _slice_between(text, "[[", "]]") or _slice_between(text, "[", "]") or text
 
-    # 去掉 ``` 包裹
-    if text.startswith("```"):
-        text = text.strip("`").strip()
-
-    # 先 JSON
+    # 先 JSON（orjson 可用时走 orjson；正常输出这一步就能成功）
     try:
-        obj = json.loads(text)
+        obj = _json_loads(text)
         if isinstance(obj, list):
             return obj
     except Exception:
@@ -44,53 +111,96 @@ def _parse_llm_list_of_lists(raw_text: str) -> List[List[Any]]:
     except Exception:
         pass
 
-    # 最后尝试“去转义再 loads”
-    try:
-        clean_text = text.replace('\\"', '"').replace('"\"', '"')
-        obj = json.loads(clean_text)
-        if isinstance(obj, list):
-            return obj
-    except Exception:
-        pass
+    # 最后尝试“去转义再 loads”（只有输出里确实带 \" 时才值得再拷一份字符串）
+    if '\\"' in text:
+        try:
+            clean_text = text.replace('\\"', '"').replace('"\"', '"')
+            obj = _json_loads(clean_text)
+            if isinstance(obj, list):
+                return obj
+        except Exception:
+            pass
 
     raise ValueError(f"无法解析模型输出为二维列表。输出开头：{text[:200]}")
 
 
-def _build_preview_csv(df: pd.DataFrame) -> str:
-    """控制传给模型的内容大小，避免token爆炸"""
-    if df is None or df.empty:
-        return "（空表）"
-    # 限制行列
-    sub = df.iloc[:PREVIEW_ROWS, : min(PREVIEW_COLS, df.shape[1])]
-    return sub.to_csv(index=False)
+def _parse_llm_sheet_dict(raw_text: str) -> Dict[str, List[List[Any]]]:
+    """解析合并请求的输出：{sheet名: 二维列表}"""
+    if raw_text is None:
+        raise ValueError("模型返回为空")
+    text = _RE_FENCE.sub('', raw_text.strip())
+    text = _slice_between(text, "{", "}") or text
 
+    obj = _json_loads(text)
+    if not isinstance(obj, dict) or not all(isinstance(v, list) for v in obj.values()):
+        raise ValueError(f"无法解析模型输出为 {{sheet: 二维列表}}。输出开头：{text[:200]}")
+    return {str(k): v for k, v in obj.items()}
 
-def analyze_data_with_llm(
-    df: Any,
-    api_key: Optional[str] = None,
-    base_url: str = "https://dashscope.aliyuncs.com/compatible-mode/v1",
-    model: str = "qwen3-max",
-    timeout_sec: int = DEFAULT_TIMEOUT_SEC,
-    retries: int = DEFAULT_RETRIES,
-) -> List[List[Any]]:
-    """调用通义千问（OpenAI 兼容接口）做映射清洗"""
-    if api_key is None:
-        api_key = os.getenv("DASHSCOPE_API_KEY")
-    if not api_key:
-        raise RuntimeError("未检测到环境变量 DASHSCOPE_API_KEY（请在WSGI或环境变量中配置）")
 
-    client = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout_sec)
+# 映射规则里明确不处理的单位名称关键字；首列命中的行在本地就去掉，不占 token
+_SKIP_UNIT_PATTERN = "未划分|合计|战客"
 
-    # 只传预览，避免超长
-    if isinstance(df, pd.DataFrame):
-        preview = _build_preview_csv(df)
-    else:
-        preview = str(df)[:5000]
 
-    prompt = f"""
-新建一个对话，你是一个专业的数据分析助手，请严格按照以下要求处理数据：
-数据来源（CSV预览，含表头+部分数据）：\n{preview}
+def _compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """去掉整行为空、首列是“合计”等不处理的行、以及没有表头且整列为空的部分，再限制列数"""
+    sub = df.dropna(how="all")
+    empty_cols = [c for c in sub.columns if str(c).startswith("Unnamed") and sub[c].isna().all()]
+    sub = sub.drop(columns=empty_cols)
+    # 先去掉空列再看首列：表/区域从空白列开始时，首列才是真正的单位名称列
+    if AI_PREFILTER and sub.shape[1]:
+        sub = sub[~sub.iloc[:, 0].astype(str).str.contains(_SKIP_UNIT_PATTERN, na=False)]
+    sub = sub.iloc[:, : min(PREVIEW_COLS, sub.shape[1])]
+    # 长文本截断（只动字符串，空值保持为空）
+    text_cols = sub.select_dtypes(include=["object", "string"]).columns
+    if len(text_cols):
+        sub = sub.copy()
+        for c in text_cols:
+            sub[c] = sub[c].map(lambda v: v[:PREVIEW_CELL_CHARS] if isinstance(v, str) else v)
+    return sub
+
+
+def _to_preview_text(sub: pd.DataFrame) -> str:
+    # 用制表符分隔：数字里的千分位逗号等不再触发引号转义；
+    # 固定 \n 换行、浮点数去掉 0.30000000000000004 这类尾巴，token 更少
+    return sub.to_csv(index=False, sep="\t", lineterminator="\n", float_format="%.10g")
+
+
+def _build_preview_csv(df: pd.DataFrame) -> str:
+    """控制传给模型的内容大小，避免token爆炸"""
+    if df is None or df.empty:
+        return "（空表）"
+    return _to_preview_text(_compact_frame(df).iloc[:PREVIEW_ROWS])
+
 
+def _detect_header_rows(sub: pd.DataFrame, limit: int = 10) -> int:
+    """数出开头的表头行：第一行出现数值的行之前都算表头（整表读入时多行表头在数据行里）
+    前 limit 行都没有数值时认不出来，返回 0，避免把数据行当表头重复发送
+    """
+    for n, row in enumerate(sub.iloc[:limit].itertuples(index=False)):
+        if any(isinstance(v, numbers.Number) and not isinstance(v, bool) and v == v for v in row):
+            return n
+    return 0
+
+
+def _build_preview_chunks(df: pd.DataFrame) -> List[str]:
+    """整表按 AI_CHUNK_ROWS 行切块，每块都带表头，让模型看到所有数据行；不切块时只发前 PREVIEW_ROWS 行"""
+    if AI_CHUNK_ROWS <= 0 or df is None or df.empty:
+        return [_build_preview_csv(df)]
+    sub = _compact_frame(df)
+    # 第 2 块起只剩 Unnamed 列名，要把开头的表头行一并带上，模型才知道各列是什么
+    header_rows = AI_HEADER_ROWS if AI_HEADER_ROWS >= 0 else _detect_header_rows(sub)
+    header = sub.iloc[:header_rows]
+    chunks = []
+    for start in range(0, len(sub), AI_CHUNK_ROWS):
+        part = sub.iloc[start:start + AI_CHUNK_ROWS]
+        if start > 0 and header_rows > 0:
+            part = pd.concat([header, part])
+        chunks.append(_to_preview_text(part))
+    return chunks or ["（空表）"]
+
+
+# 映射规则：单sheet和多sheet合并请求共用
+_MAPPING_RULES = """
 这个表前面行是表头，后面是数据，要从前面映射各产品，获取后面对应的数据。
 一、数据清洗与预处理：
 1. 数据筛选规则：
@@ -111,96 +221,551 @@ def analyze_data_with_llm(
 - 按优先级匹配字段名
 - 关键词必须满足要求（避免日/月混淆）
 - 找不到对应字段输出 -1.5
+"""
+
+# 结果表表头（与队友输出对齐：包含产品/排名/备注列）和其中的数值列
+HEADERS = ["单位名称", "日目标", "日发展", "日发展完成率",
+           "月目标", "月累计发展", "月完成率", "得分", "旗县", "产品", "排名", "备注"]
+NUMERIC_HEADERS = ["日目标", "日发展", "日发展完成率", "月目标", "月累计发展", "月完成率", "得分"]
+
+_ROW_FORMAT = '["单位名称","日目标","日发展","日发展完成率","月目标","月累计发展","月完成率","得分","旗县"]'
 
+# 提示词固定部分在模块加载时拼好，每次请求只把预览夹在中间
+_PROMPT_HEAD = """
+新建一个对话，你是一个专业的数据分析助手，请严格按照以下要求处理数据：
+数据来源（TSV预览，制表符分隔，含表头+部分数据）：
+"""
+_PROMPT_TAIL = "\n" + _MAPPING_RULES + """
 二、输出格式要求：
 - 只返回一个合法的二维列表(list of lists)，以 [[ 开始，以 ]] 结束，中间无额外内容
 - 不要表头（只输出数据行）
-- 每行严格为：["单位名称","日目标","日发展","日发展完成率","月目标","月累计发展","月完成率","得分","旗县"]
+- 每行严格为：""" + _ROW_FORMAT + "\n"
+
+_BATCH_PROMPT_HEAD = """
+新建一个对话，你是一个专业的数据分析助手，下面有多个表（每个表以"### SHEET 表名"开头），请对每个表分别严格按照以下要求处理数据：
+数据来源（TSV预览，制表符分隔，含表头+部分数据）：
 """
+_BATCH_PROMPT_TAIL = "\n" + _MAPPING_RULES + """
+二、输出格式要求：
+- 只返回一个合法的JSON对象，以 { 开始，以 } 结束，中间无额外内容
+- 键为表名（与"### SHEET"后的名称完全一致），值为该表的二维列表(list of lists)
+- 不要表头（只输出数据行）
+- 每行严格为：""" + _ROW_FORMAT + "\n"
+
+
+# 提示词/解析逻辑有语义变化时改一下，让旧缓存全部失效
+PROMPT_VERSION = "1"
+
+_MEMORY_CACHE_SIZE = 256
+_memory_cache: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (写入时间, 结果)，同进程内免查 sqlite
+_memory_cache_lock = threading.Lock()
+
+
+def _cache_key(model: str, prompt: str) -> str:
+    return hashlib.sha256((model + PROMPT_VERSION + prompt).encode("utf-8")).hexdigest()
+
+
+def _cache_expired(created: float) -> bool:
+    return AI_CACHE_TTL_SEC > 0 and time.time() - created > AI_CACHE_TTL_SEC
+
+
+def _memory_cache_put(key: str, created: float, value: List[List[Any]]) -> None:
+    with _memory_cache_lock:
+        _memory_cache[key] = (created, value)
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > _MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def _cache_get(key: str) -> Optional[List[List[Any]]]:
+    """查缓存（先内存后 sqlite）；过期或缓存不可用时当作未命中"""
+    if not AI_CACHE_PATH:
+        return None
+    with _memory_cache_lock:
+        hit = _memory_cache.get(key)
+    if hit is not None and not _cache_expired(hit[0]):
+        return hit[1]
+    try:
+        with closing(sqlite3.connect(AI_CACHE_PATH)) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS llm_results (key TEXT PRIMARY KEY, created REAL, value TEXT)")
+            row = conn.execute("SELECT created, value FROM llm_results WHERE key = ?", (key,)).fetchone()
+        if row is None or _cache_expired(row[0]):
+            return None
+        value = json.loads(row[1])
+        _memory_cache_put(key, row[0], value)
+        return value
+    except Exception:
+        return None
+
+
+def _cache_put(key: str, value: List[List[Any]]) -> None:
+    if not AI_CACHE_PATH:
+        return
+    created = time.time()
+    _memory_cache_put(key, created, value)
+    try:
+        with closing(sqlite3.connect(AI_CACHE_PATH)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS llm_results (key TEXT PRIMARY KEY, created REAL, value TEXT)")
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_results (key, created, value) VALUES (?, ?, ?)",
+                (key, created, json.dumps(value, ensure_ascii=False)),
+            )
+    except Exception:
+        pass
+
+
+def _build_sheet_prompt(preview: str) -> str:
+    return _PROMPT_HEAD + preview + _PROMPT_TAIL
+
+
+@functools.lru_cache(maxsize=8)
+def _get_client(api_key: str, base_url: str, timeout_sec: int) -> OpenAI:
+    """按 (api_key, base_url, timeout) 复用客户端，连接池和 TLS 会话跨请求保留；换 key 多了也只留最近 8 个"""
+    # 重试统一由 _chat_with_retries 负责，关掉 SDK 自带的重试，避免两层叠加成倍放大请求数
+    return OpenAI(api_key=api_key, base_url=base_url, timeout=timeout_sec, max_retries=0)
+
+
+def _complete(client: OpenAI, model: str, prompt: str, json_mode: bool = False) -> str:
+    """发一次对话请求，返回模型输出的完整文本；AI_STREAM 打开时边收边拼
+    json_mode=True 时要求接口只输出一个 JSON 对象（prompt 里必须出现 “JSON” 字样）
+    """
+    kwargs: Dict[str, Any] = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt},
+        ],
+    }
+    if json_mode:
+        kwargs["response_format"] = {"type": "json_object"}
+    if not AI_STREAM:
+        completion = client.chat.completions.create(**kwargs)
+        return completion.choices[0].message.content
+
+    parts: List[str] = []
+    stream = client.chat.completions.create(stream=True, **kwargs)
+    for chunk in stream:
+        # 部分兼容接口最后会发一个不带 choices 的统计块
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+    return "".join(parts)
+
+
+# 值得重试的错误：限流、超时、断网、服务端 5xx，以及模型输出解析失败（ValueError）；
+# 鉴权失败、参数错误这类重试也没用，直接抛出
+_RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError, ValueError)
+
+
+def _retry_delay(err: Exception, attempt: int) -> float:
+    """第 attempt 次失败后等多久：指数退避 + 随机抖动；接口给了 Retry-After 就至少等这么久"""
+    delay = AI_BACKOFF_SEC * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+    response = getattr(err, "response", None)
+    if response is not None:
+        try:
+            delay = max(delay, float(response.headers.get("retry-after")))
+        except (TypeError, ValueError):
+            pass
+    return min(delay, AI_BACKOFF_MAX_SEC)
+
+
+def _chat_with_retries(
+    prompt: str,
+    parse_fn: Callable[[str], Any],
+    api_key: Optional[str],
+    base_url: str,
+    model: str,
+    timeout_sec: int,
+    retries: int,
+    json_mode: bool = False,
+) -> Any:
+    """发一次对话请求并用 parse_fn 解析；临时性错误（见 _RETRYABLE_ERRORS）会退避后重试"""
+    if api_key is None:
+        api_key = os.getenv("DASHSCOPE_API_KEY")
+    if not api_key:
+        raise RuntimeError("未检测到环境变量 DASHSCOPE_API_KEY（请在WSGI或环境变量中配置）")
+
+    client = _get_client(api_key, base_url, timeout_sec)
 
     last_err: Optional[Exception] = None
     for attempt in range(1, retries + 1):
         try:
-            completion = client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": prompt},
-                ],
-            )
-            content = completion.choices[0].message.content
-            return _parse_llm_list_of_lists(content)
-        except Exception as e:
+            content = _complete(client, model, prompt, json_mode)
+            return parse_fn(content)
+        except _RETRYABLE_ERRORS as e:
             last_err = e
             # 最后一次失败就抛出
             if attempt == retries:
                 raise
+            # 随机抖动：多个sheet并发时不会同时重试
+            time.sleep(_retry_delay(e, attempt))
     # 理论到不了这里
     raise RuntimeError(f"AI调用失败：{last_err}")
 
 
-def _read_excel_sheet(file_path: str, sheet_name: str, skiprows: int = 1, nrows: int = None, usecols: str = None):
-    return pd.read_excel(
-        file_path,
-        sheet_name=sheet_name,
-        skiprows=skiprows,
-        nrows=nrows,
-        usecols=usecols
+def analyze_data_with_llm(
+    df: Any,
+    api_key: Optional[str] = None,
+    base_url: str = "https://dashscope.aliyuncs.com/compatible-mode/v1",
+    model: str = "qwen3-max",
+    timeout_sec: int = DEFAULT_TIMEOUT_SEC,
+    retries: int = DEFAULT_RETRIES,
+) -> List[List[Any]]:
+    """调用通义千问（OpenAI 兼容接口）做映射清洗"""
+    # 只传预览，避免超长
+    if isinstance(df, pd.DataFrame):
+        preview = _build_preview_csv(df)
+    else:
+        preview = str(df)[:5000]
+    return analyze_preview(preview, api_key, base_url, model, timeout_sec, retries)
+
+
+def analyze_preview(
+    preview: str,
+    api_key: Optional[str] = None,
+    base_url: str = "https://dashscope.aliyuncs.com/compatible-mode/v1",
+    model: str = "qwen3-max",
+    timeout_sec: int = DEFAULT_TIMEOUT_SEC,
+    retries: int = DEFAULT_RETRIES,
+) -> List[List[Any]]:
+    """同 analyze_data_with_llm，但直接接收已经生成好的预览文本（调用方可以先释放 DataFrame）"""
+    prompt = _build_sheet_prompt(preview)
+    key = _cache_key(model, prompt)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    result = _chat_with_retries(prompt, _parse_llm_list_of_lists, api_key, base_url, model, timeout_sec, retries)
+    _cache_put(key, result)
+    return result
+
+
+def analyze_sheets_batched(
+    previews: Dict[str, str],
+    api_key: Optional[str] = None,
+    base_url: str = "https://dashscope.aliyuncs.com/compatible-mode/v1",
+    model: str = "qwen3-max",
+    timeout_sec: int = DEFAULT_TIMEOUT_SEC,
+    retries: int = DEFAULT_RETRIES,
+) -> Dict[str, List[List[Any]]]:
+    """多个sheet的预览合并成一次请求，映射规则只发一遍；返回 {sheet名: 二维列表}
+    缓存按单sheet的 key 存取，所以合并请求和单sheet请求可以互相命中
+    """
+    keys = {name: _cache_key(model, _build_sheet_prompt(preview)) for name, preview in previews.items()}
+    results = {}
+    for name, key in keys.items():
+        cached = _cache_get(key)
+        if cached is not None:
+            results[name] = cached
+    pending = {name: preview for name, preview in previews.items() if name not in results}
+    if not pending:
+        return results
+
+    blocks = "\n".join(f"### SHEET {name}\n{preview}" for name, preview in pending.items())
+    prompt = _BATCH_PROMPT_HEAD + blocks + _BATCH_PROMPT_TAIL
+    batched = _chat_with_retries(
+        prompt, _parse_llm_sheet_dict, api_key, base_url, model, timeout_sec, retries, json_mode=AI_JSON_MODE
     )
+    for name, rows in batched.items():
+        if name in pending:
+            _cache_put(keys[name], rows)
+            results[name] = rows
+    return results
+
+
+def _header_names(header: tuple) -> List[Any]:
+    """表头行转列名，规则同 pandas：空表头叫 "Unnamed: j"，重名加 ".1"、".2" 后缀"""
+    names = []
+    seen: Dict[Any, int] = {}
+    for j, value in enumerate(header):
+        name = f"Unnamed: {j}" if value is None else value
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def _calamine_value(value: Any) -> Any:
+    """calamine 单元格值换成 openpyxl 的样子：空单元格是 None，整数存成的浮点数还原成 int，
+    纯日期（date）补成 datetime，这样预览文本和缓存 key 与 openpyxl 读出来的完全一致
+    """
+    if value == "":
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return datetime.datetime(value.year, value.month, value.day)
+    return value
+
+
+class _CalamineSheet:
+    """把 calamine 的 sheet 包成 openpyxl 只读 sheet 的样子，_sheet_to_df 不用区分引擎"""
+
+    def __init__(self, sheet: Any) -> None:
+        self._sheet = sheet
+
+    def iter_rows(self, min_row: int = 1, max_row: int = None, min_col: int = None, max_col: int = None,
+                  values_only: bool = True):
+        # 区间为空时和 openpyxl 一样什么都不出；calamine 的 nrows 不接受负数
+        if max_row is not None and max_row < min_row:
+            return
+        # skip_empty_area=False：从 A1 开始算行列，和 openpyxl 的行号列号对齐
+        data = self._sheet.to_python(skip_empty_area=False, nrows=max_row)
+        start = (min_col or 1) - 1
+        width = max_col - start if max_col else None
+        for row in data[min_row - 1:]:
+            cells = [_calamine_value(v) for v in row[start:max_col]]
+            if width is not None and len(cells) < width:
+                cells.extend([None] * (width - len(cells)))
+            yield tuple(cells)
+
+
+class _CalamineReport:
+    """把 CalamineWorkbook 包成 openpyxl 只读工作簿的样子（sheetnames / wb[name] / close）"""
+
+    def __init__(self, path: str) -> None:
+        from python_calamine import CalamineWorkbook
+        self._wb = CalamineWorkbook.from_path(path)
+        self.sheetnames = list(self._wb.sheet_names)
+
+    def __getitem__(self, sheet_name: str) -> _CalamineSheet:
+        return _CalamineSheet(self._wb.get_sheet_by_name(sheet_name))
+
+    def close(self) -> None:
+        close = getattr(self._wb, "close", None)  # 老版本 python-calamine 没有 close
+        if close is not None:
+            close()
+
+
+def _open_report(path: str):
+    """报表只打开一次：EXCEL_ENGINE=calamine 时用 calamine，否则用 openpyxl 只读模式（按需流式读行）"""
+    if EXCEL_ENGINE == "calamine":
+        return _CalamineReport(path)
+    return load_workbook(path, read_only=True, data_only=True)
+
+
+def _sheet_to_df(
+    wb,
+    sheet_name: str,
+    skiprows: int = 1,
+    nrows: int = None,
+    min_col: int = None,
+    max_col: int = None,
+) -> pd.DataFrame:
+    """从只读工作簿里按行流式取出区域，效果等同 pd.read_excel(sheet_name, skiprows, nrows, usecols="A:C")
+    列范围直接传 1 起的整数下标（A=1）；只读模式不会把整张表加载进内存，取到 max_row 就停
+    """
+    max_row = skiprows + 1 + nrows if nrows is not None else None
+
+    ws = wb[sheet_name]
+    # 只读模式默认按文件里存的 <dimension> 定边界，这个值可能缺失或过期（如只写了 A1），丢掉它按实际行读
+    if hasattr(ws, "reset_dimensions"):
+        ws.reset_dimensions()
+    rows = list(ws.iter_rows(
+        min_row=skiprows + 1, max_row=max_row, min_col=min_col, max_col=max_col, values_only=True
+    ))
+    if not rows:
+        return pd.DataFrame()
+    # 去掉末尾的空行（和 pandas 一致）
+    while len(rows) > 1 and all(v is None for v in rows[-1]):
+        rows.pop()
+
+    width = max(len(r) for r in rows)
+    rows = [tuple(r) + (None,) * (width - len(r)) for r in rows]
+    return pd.DataFrame(rows[1:], columns=_header_names(rows[0]))
+
+
+def _analyze_sheet(preview: str, target_sheet: str, log_fn: Callable[[str], None]) -> List[List[Any]]:
+    """单个sheet调AI（关键：有超时 + 有日志 + 失败不中断整体）"""
+    try:
+        all_data = analyze_preview(preview)
+        log_fn(f"AI返回成功 ✅ {target_sheet} 行数={len(all_data)}")
+        return all_data
+    except Exception as e:
+        log_fn(f"AI调用失败：{target_sheet} {type(e).__name__}: {e}")
+        return []
+
+
+def _analyze_batch(batch: List[tuple], log_fn: Callable[[str], None]) -> Dict[tuple, List[List[Any]]]:
+    """一批sheet（块）合并成一次AI请求；合并请求失败或缺了某个sheet时，退回逐个调用"""
+    if len(batch) == 1:
+        key, name, preview = batch[0]
+        return {key: _analyze_sheet(preview, name, log_fn)}
+
+    names = [name for _, name, _ in batch]
+    try:
+        batched = analyze_sheets_batched({name: preview for _, name, preview in batch})
+    except Exception as e:
+        log_fn(f"合并请求失败，改为逐个sheet调用：{'、'.join(names)} {type(e).__name__}: {e}")
+        batched = {}
+
+    results = {}
+    for key, name, preview in batch:
+        if name in batched:
+            results[key] = batched[name]
+            log_fn(f"AI返回成功 ✅ {name} 行数={len(results[key])}")
+        else:
+            results[key] = _analyze_sheet(preview, name, log_fn)
+    return results
+
+
+def _make_batches(jobs: List[tuple], max_chars: int) -> List[List[tuple]]:
+    """按预览字符数把 jobs 切成若干批；同一批里不放重名sheet"""
+    batches = []
+    current = []
+    current_chars = 0
+    for job in jobs:
+        size = len(job[2])
+        if current and (
+            max_chars <= 0
+            or current_chars + size > max_chars
+            or any(job[1] == other[1] for other in current)
+        ):
+            batches.append(current)
+            current = []
+            current_chars = 0
+        current.append(job)
+        current_chars += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _build_output_row(row_data: Any, product_col_index: int, target_sheet: str) -> List[Any]:
+    """把模型返回的一行补齐到“产品”列，并写入 sheet 名（超出部分原样保留）"""
+    row = list(row_data) if isinstance(row_data, (list, tuple)) else [row_data]
+    if len(row) < product_col_index:
+        row.extend([None] * (product_col_index - len(row)))
+    row[product_col_index - 1] = target_sheet
+    return row
+
+
+def _to_number(value: Any) -> Any:
+    """能转成数字的转成数字（写出为数值单元格），转不了的原样保留"""
+    if isinstance(value, str):
+        text = value.strip()
+        for convert in (int, float):
+            try:
+                number = convert(text)
+            except ValueError:
+                continue
+            return number if math.isfinite(number) else value
+    return value
+
+
+def _to_cell(value: Any) -> Any:
+    """写出前清洗单元格：NaN/Inf 写成空格子，模型偶尔返回的嵌套列表/字典转成 JSON 文本（xlsxwriter 都写不了）"""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def _iter_result_rows(sheets: List[tuple], results: Dict[tuple, List[List[Any]]],
+                      product_col_index: int, width: int):
+    """按参数表顺序、块顺序逐行产出结果行（不足表头宽度的补空，超出部分原样保留；数值列转数字，单元格见 _to_cell）"""
+    numeric_cols = [HEADERS.index(h) for h in NUMERIC_HEADERS]
+    for i, target_sheet, n_chunks in sheets:
+        for k in range(n_chunks):
+            for row_data in results.get((i, k), []):
+                row = _build_output_row(row_data, product_col_index, target_sheet)
+                if len(row) < width:
+                    row.extend([None] * (width - len(row)))
+                for j in numeric_cols:
+                    row[j] = _to_number(row[j])
+                yield [_to_cell(v) for v in row]
+
+
+def _write_result(out_path: str, headers: List[str], rows) -> None:
+    """边生成边写出，不在内存里拼整张结果表
+    先写到同目录的临时文件，写完再改名成 out_path：状态接口看到 out_path 存在就算完成，不能让它拿到写了一半的文件
+    """
+    tmp_path = out_path + ".tmp"
+    try:
+        if out_path.lower().endswith(".csv"):
+            # CSV 比 xlsx 快得多（没有 zip/xml）；带 BOM 方便 Excel 直接打开中文
+            with open(tmp_path, "w", newline="", encoding="utf-8-sig") as f:
+                writer = csv.writer(f)
+                writer.writerow(headers)
+                writer.writerows(rows)
+        else:
+            # constant_memory：每写完一行就落盘，内存只保留当前行
+            # strings_to_urls=False：单元格文本原样写出，不逐个做 URL 匹配、也不会被转成超链接
+            wb = xlsxwriter.Workbook(tmp_path, {"constant_memory": True, "strings_to_urls": False})
+            try:
+                ws = wb.add_worksheet("Result")
+                ws.write_row(0, 0, headers)
+                for r, row in enumerate(rows, start=1):
+                    ws.write_row(r, 0, row)
+            finally:
+                wb.close()
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
 
 def process_excel(param_path: str, report_path: str, out_path: str, log_fn: Callable[[str], None] = lambda _: None) -> None:
     """
-    网站入口：读取参数表 + 报表，调用 AI 做映射，写出 out_path
+    网站入口：读取参数表 + 报表，调用 AI 做映射，写出 out_path（.csv 结尾写 CSV，否则写 xlsx）
     注意：无论中途发生什么，都会在 finally 尝试写出 out_path，保证可下载
     """
-    wb = Workbook()
-    ws1 = wb.active
-
-    # 表头（与队友输出对齐：包含产品/排名/备注列）
-    all_headers = ["单位名称", "日目标", "日发展", "日发展完成率",
-                   "月目标", "月累计发展", "月完成率", "得分", "旗县", "产品", "排名", "备注"]
-    for col, header in enumerate(all_headers, start=1):
-        ws1.cell(row=1, column=col, value=header)
+    all_headers = HEADERS
     product_col_index = all_headers.index("产品") + 1
-    hangshu = 2
+    sheets = []  # (参数表行号, sheet名, 块数)
+    results = {}  # (参数表行号, 块序号) -> 模型返回的二维列表
+    wb_report = None
 
     try:
         log_fn("读取参数表…")
-        df_param_all = pd.read_excel(param_path)
-        shifou = df_param_all.iloc[0, 1] if df_param_all.shape[1] > 1 else 0
+        # 参数表只需要 B2 和 A3:C6 这几个单元格，只读模式直接取，不用 pandas 解析整张表
+        wb_param = load_workbook(param_path, read_only=True, data_only=True)
+        try:
+            ws_param = wb_param.worksheets[0]
+            # 文件里存的 <dimension> 可能缺失或过期，列数按前两行实际内容算（去掉行尾空格子，同 pandas）
+            ws_param.reset_dimensions()
+            top = [list(row) for row in ws_param.iter_rows(max_row=2, values_only=True)]
+            for row in top:
+                while row and row[-1] is None:
+                    row.pop()
+            width = max((len(row) for row in top), default=0)
+            b2 = top[1][1] if len(top) > 1 and len(top[1]) > 1 else None
+            # B2 为空时不算 0（与原先 pandas 读出 NaN 的判断一致）；只有一列时按 0 处理
+            shifou = b2 if width > 1 else 0
+            if shifou == 0:
+                # A:C 第3~6行（按你队友逻辑：第2行是表头）；和 pandas 一样去掉末尾的空行
+                canshu_list = [
+                    list(row)
+                    for row in ws_param.iter_rows(min_row=3, max_row=6, min_col=1, max_col=3, values_only=True)
+                ]
+                while canshu_list and all(v is None for v in canshu_list[-1]):
+                    canshu_list.pop()
+        finally:
+            wb_param.close()
 
         numbers_list = []
         letters_list = []
-        canshu_list = []
+        jobs = []  # ((参数表行号, 块序号), 显示名, 预览文本)
+
+        # 报表只打开一次（引擎见 EXCEL_ENGINE），后续所有sheet都从这里取
+        wb_report = _open_report(report_path)
+        sheet_names = wb_report.sheetnames
+        sheet_name_set = frozenset(sheet_names)  # 参数表逐行判断sheet是否存在，用集合查
 
         if shifou == 0:
-            # A:C + nrows=4 + skiprows=1（按你队友逻辑）
-            canshu = pd.read_excel(param_path, usecols="A:C", nrows=4, skiprows=1)
-            canshu_list = canshu.values.tolist()
-
-            for _, row in canshu.iterrows():
-                row_numbers = []
-                row_letters = []
-                for col_index in [1, 2]:
-                    item = row.iloc[col_index]
-                    if pd.isna(item):
-                        numbers = ''
-                        letters = ''
-                    else:
-                        item_str = str(item)
-                        numbers = ''.join(re.findall(r'\d+', item_str))
-                        letters = ''.join(re.findall(r'[a-zA-Z]+', item_str))
-                    row_numbers.append(numbers)
-                    row_letters.append(letters)
-                numbers_list.append(row_numbers)
-                letters_list.append(row_letters)
+            # B、C 两列拆出数字/字母（如 "A5" -> "5"/"A"），空单元格得到空串
+            # 参数表只有 4x2 个单元格，直接遍历已取出的二维列表，比 DataFrame.apply 的固定开销小
+            for row in canshu_list:
+                cells = ['' if item is None else str(item) for item in row[1:3]]
+                numbers_list.append([c.translate(_KEEP_DIGITS) for c in cells])
+                letters_list.append([c.translate(_KEEP_LETTERS) for c in cells])
         else:
-            xls_report = pd.ExcelFile(report_path)
-            canshu_list = [[s] for s in xls_report.sheet_names]
+            canshu_list = [[s] for s in sheet_names]
 
-        xls = pd.ExcelFile(report_path)
-        sheet_names = xls.sheet_names
         log_fn(f"报表包含 {len(sheet_names)} 个sheet")
 
         # 遍历参数表指定的 sheet
@@ -210,57 +775,66 @@ def process_excel(param_path: str, report_path: str, out_path: str, log_fn: Call
                 break
 
             target_sheet = canshu_list[i][0]
-            if target_sheet not in sheet_names:
+            if target_sheet not in sheet_name_set:
                 log_fn(f"跳过：sheet不存在 {target_sheet}")
                 continue
 
-            log_fn(f"处理sheet：{target_sheet}")
+            log_fn(f"读取sheet：{target_sheet}")
 
             # 读表
             if shifou == 0:
                 try:
                     number = int(numbers_list[i][1]) - int(numbers_list[i][0]) - 4
-                    letter1 = letters_list[i][0]
-                    letter2 = letters_list[i][1]
-                    range_str = f"{letter1}:{letter2}"
+                    # 列字母在这里一次换成整数下标，字母不合法也在这里报出来
+                    min_col = column_index_from_string(letters_list[i][0])
+                    max_col = column_index_from_string(letters_list[i][1])
+                    # 起止写反时（如 A10 / C5）行数或列数为负，两种引擎都读不出东西，直接按参数错误跳过
+                    if number < 0 or max_col < min_col:
+                        raise ValueError(f"范围起止写反了：{numbers_list[i]} / {letters_list[i]}")
                 except Exception as e:
                     log_fn(f"参数表范围解析失败：{type(e).__name__}: {e}，跳过该sheet")
                     continue
 
-                df = _read_excel_sheet(
-                    file_path=report_path,
+                df = _sheet_to_df(
+                    wb_report,
                     sheet_name=target_sheet,
                     skiprows=4,
                     nrows=number,
-                    usecols=range_str,
+                    min_col=min_col,
+                    max_col=max_col,
                 )
             else:
-                df = _read_excel_sheet(
-                    file_path=report_path,
+                df = _sheet_to_df(
+                    wb_report,
                     sheet_name=target_sheet,
                     skiprows=1
                 )
 
-            # 调 AI（关键：有超时 + 有日志 + 失败不中断整体）
-            log_fn("准备调用AI…")
-            try:
-                all_data = analyze_data_with_llm(df)
-                log_fn(f"AI返回成功 ✅ 行数={len(all_data)}")
-            except Exception as e:
-                log_fn(f"AI调用失败：{type(e).__name__}: {e}")
-                all_data = []
-
-            # 写入
-            for row_data in all_data:
-                for col_idx, value in enumerate(row_data, 1):
-                    ws1.cell(row=hangshu, column=col_idx, value=value)
-                ws1.cell(row=hangshu, column=product_col_index, value=target_sheet)
-                hangshu += 1
+            # 读完立刻转成预览文本并释放 DataFrame，避免所有sheet的表同时占着内存等AI返回
+            previews = _build_preview_chunks(df)
+            del df
+            sheets.append((i, target_sheet, len(previews)))
+            for k, preview in enumerate(previews):
+                name = target_sheet if len(previews) == 1 else f"{target_sheet}（第{k + 1}/{len(previews)}块）"
+                jobs.append(((i, k), name, preview))
+
+        # 调 AI：小sheet合并成一次请求；网络IO为主，各批并发请求，总耗时≈最慢的那批
+        if jobs:
+            batches = _make_batches(jobs, AI_BATCH_CHARS)
+            workers = min(AI_CONCURRENCY, len(batches))
+            log_fn(f"准备调用AI…（{len(sheets)} 个sheet，{len(jobs)} 块，{len(batches)} 次请求，并发 {workers}）")
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                futures = [ex.submit(_analyze_batch, batch, log_fn) for batch in batches]
+                for future in as_completed(futures):
+                    results.update(future.result())
 
     finally:
         # 无论怎样都尝试写出，保证下载不再提示“尚未生成”
+        if wb_report is not None:
+            wb_report.close()
         log_fn("写出结果文件…")
         # outputs 目录不存在也创建一下（双保险）
         os.makedirs(os.path.dirname(out_path), exist_ok=True)
-        wb.save(out_path)
+        _write_result(out_path, all_headers,
+                      _iter_result_rows(sheets, results, product_col_index, len(all_headers)))
         log_fn("写出完成 ✅")
\ No newline at end of file
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""任务日志/状态（sqlite）和后台任务入口
+
+进程池用 spawn，子进程只会导入本模块（不会导入 app.py），所以这里不能有导入时的副作用：
+不建表、不建目录、不建 Flask 应用；建表由 app.py 启动时调用 init_db()
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from processor import process_excel
+
+# 日志与状态存 sqlite（WAL），gunicorn 多 worker / 重载后任意进程都能查到
+TASK_DB_PATH = os.getenv("TASK_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tasks.db"))
+TASK_RETENTION_SEC = int(os.getenv("TASK_RETENTION_SEC", str(7 * 24 * 3600)))  # 任务日志/状态保留多久；0表示不清理
+
+_db_local = threading.local()
+
+
+def init_db():
+    with closing(sqlite3.connect(TASK_DB_PATH)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS logs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, task_id TEXT NOT NULL, ts REAL NOT NULL, msg TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_task ON logs (task_id, id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS status (task_id TEXT PRIMARY KEY, state TEXT NOT NULL, error TEXT)")
+    prune_tasks()
+
+
+def prune_tasks():
+    # 按任务整体清理：最后一条日志早于保留期的任务，日志和状态一起删，不会只剩半截日志
+    if TASK_RETENTION_SEC <= 0:
+        return
+    cutoff = time.time() - TASK_RETENTION_SEC
+    old_tasks = "SELECT task_id FROM logs GROUP BY task_id HAVING MAX(ts) < ?"
+    with closing(sqlite3.connect(TASK_DB_PATH, timeout=30)) as conn:
+        with conn:
+            conn.execute(f"DELETE FROM status WHERE task_id IN ({old_tasks})", (cutoff,))
+            conn.execute(f"DELETE FROM logs WHERE task_id IN ({old_tasks})", (cutoff,))
+
+
+def get_db() -> sqlite3.Connection:
+    # 每个线程一个连接（后台线程、AI 并发线程都会写日志）
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(TASK_DB_PATH, timeout=30)
+        _db_local.conn = conn
+    return conn
+
+
+def add_log(task_id: str, msg: str):
+    # 只存时间戳，格式化放到 get_log 读的时候做（轮询频率远低于写日志频率）
+    conn = get_db()
+    with conn:
+        conn.execute("INSERT INTO logs (task_id, ts, msg) VALUES (?, ?, ?)", (task_id, time.time(), msg))
+
+
+def format_log(ts: float, msg: str) -> str:
+    return f"[{time.strftime('%H:%M:%S', time.localtime(ts))}] {msg}"
+
+
+def set_status(task_id: str, state: str, error: str = None):
+    conn = get_db()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO status (task_id, state, error) VALUES (?, ?, ?)",
+            (task_id, state, error),
+        )
+
+
+def get_status(task_id: str):
+    row = get_db().execute("SELECT state, error FROM status WHERE task_id = ?", (task_id,)).fetchone()
+    return {"state": row[0], "error": row[1]} if row else None
+
+
+def run_task(task_id: str, param_path: str, report_path: str, out_path: str):
+    try:
+        add_log(task_id, "后台任务开始执行…")
+        process_excel(param_path, report_path, out_path, log_fn=lambda m: add_log(task_id, m))
+        add_log(task_id, "后台任务完成 ✅")
+        set_status(task_id, "done")
+    except Exception as e:
+        add_log(task_id, f"后台任务失败 ❌：{type(e).__name__}: {e}")
+        set_status(task_id, "error", f"{type(e).__name__}: {e}")
+    # 长期运行的服务不一定会重启，每个任务结束时顺手清一次过期任务
+    prune_tasks()